@@ -3,26 +3,92 @@ import argparse
 import json
 import os
 import sys
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from datetime import datetime
 from pathlib import Path
-from typing import Any, Dict, Optional, Tuple
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
 
 import requests
 from requests.adapters import HTTPAdapter, Retry
+from urllib3.util import make_headers
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 REQUEST_TIMEOUT = 20
 DEFAULT_LIMIT = 100
+DEFAULT_CONCURRENCY = 8
+POOL_SIZE = 32
+WRITER_WORKERS = 4
+ACCEPT_ENCODING = make_headers(accept_encoding=True)["accept-encoding"]
+SYNC_STATE_FILE = ".zotero_sync.json"
+ITEM_KEY_BATCH = 50
+
+_backoff_lock = threading.Lock()
+_backoff_until = 0.0
+
+_JSON_ENCODER = json.JSONEncoder(ensure_ascii=False, check_circular=False)
+_JSON_INDENT_ENCODER = json.JSONEncoder(
+    ensure_ascii=False, check_circular=False, indent=2
+)
+
+
+def dump_json(obj: Any, indent: bool = False) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 if indent else 0)
+    encoder = _JSON_INDENT_ENCODER if indent else _JSON_ENCODER
+    return encoder.encode(obj).encode("utf-8")
+
+
+def load_json(data: bytes) -> Any:
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def write_json_stdout(obj: Any) -> None:
+    sys.stdout.flush()
+    sys.stdout.buffer.write(dump_json(obj, indent=True))
+    sys.stdout.buffer.write(b"\n")
+    sys.stdout.buffer.flush()
 
 
-def build_session() -> requests.Session:
+def record_backoff(response: requests.Response, *args: Any, **kwargs: Any) -> None:
+    global _backoff_until
+    backoff = header_int(response, "Backoff")
+    if not backoff:
+        return
+    with _backoff_lock:
+        _backoff_until = max(_backoff_until, time.monotonic() + backoff)
+
+
+def wait_for_backoff() -> None:
+    with _backoff_lock:
+        delay = _backoff_until - time.monotonic()
+    if delay > 0:
+        time.sleep(delay)
+
+
+def build_session(api_key: str, pool_size: int = POOL_SIZE) -> requests.Session:
     session = requests.Session()
+    session.headers.update(zotero_headers(api_key))
+    session.hooks["response"].append(record_backoff)
     retries = Retry(
         total=10,
         backoff_factor=1,
         allowed_methods=None,
         status_forcelist=[429, 500, 502, 503, 504],
     )
-    adapter = HTTPAdapter(max_retries=retries)
+    adapter = HTTPAdapter(
+        max_retries=retries,
+        pool_connections=pool_size,
+        pool_maxsize=pool_size,
+        pool_block=False,
+    )
     session.mount("http://", adapter)
     session.mount("https://", adapter)
     return session
@@ -43,20 +109,26 @@ def zotero_headers(api_key: str) -> Dict[str, str]:
         "Zotero-API-Key": api_key,
         "Zotero-API-Version": "3",
         "Content-Type": "application/json",
+        "Accept-Encoding": ACCEPT_ENCODING,
     }
 
 
+def header_int(response: requests.Response, name: str) -> Optional[int]:
+    value = response.headers.get(name)
+    return int(value) if value and value.isdigit() else None
+
+
 def fetch_items_page(
     session: requests.Session,
     user: str,
-    api_key: str,
     start: int,
     limit: int,
     query: Optional[str] = None,
     qmode: Optional[str] = None,
     item_type: Optional[str] = None,
     tag: Optional[str] = None,
-) -> Tuple[list, Optional[int]]:
+    item_keys: Optional[List[str]] = None,
+) -> Tuple[list, Optional[int], Optional[int]]:
     params: Dict[str, str] = {
         "format": "json",
         "start": str(start),
@@ -70,38 +142,199 @@ def fetch_items_page(
         params["itemType"] = item_type
     if tag:
         params["tag"] = tag
+    if item_keys:
+        params["itemKey"] = ",".join(item_keys)
+    wait_for_backoff()
     response = session.get(
         f"https://api.zotero.org/users/{user}/items",
-        headers=zotero_headers(api_key),
         params=params,
         timeout=REQUEST_TIMEOUT,
     )
     response.raise_for_status()
-    total = response.headers.get("Total-Results")
-    total_int = int(total) if total and total.isdigit() else None
-    return response.json(), total_int
+    total = header_int(response, "Total-Results")
+    version = header_int(response, "Last-Modified-Version")
+    return load_json(response.content), total, version
+
+
+def fetch_items_by_keys(
+    session: requests.Session,
+    user: str,
+    keys: List[str],
+) -> list:
+    items = []
+    for offset in range(0, len(keys), ITEM_KEY_BATCH):
+        batch = keys[offset : offset + ITEM_KEY_BATCH]
+        page, _, _ = fetch_items_page(session, user, 0, len(batch), item_keys=batch)
+        items.extend(page)
+    return items
+
+
+def fetch_versions(
+    session: requests.Session,
+    user: str,
+    since: int,
+    item_type: Optional[str] = None,
+) -> Tuple[Dict[str, int], Optional[int]]:
+    params: Dict[str, str] = {
+        "format": "versions",
+        "since": str(since),
+    }
+    if item_type:
+        params["itemType"] = item_type
+    wait_for_backoff()
+    response = session.get(
+        f"https://api.zotero.org/users/{user}/items",
+        headers={"If-Modified-Since-Version": str(since)},
+        params=params,
+        timeout=REQUEST_TIMEOUT,
+    )
+    if response.status_code == 304:
+        return {}, since
+    response.raise_for_status()
+    return load_json(response.content), header_int(response, "Last-Modified-Version")
 
 
 def fetch_item(
     session: requests.Session,
     user: str,
-    api_key: str,
     key: str,
+    cache_dir: Optional[Path] = None,
 ) -> Dict[str, Any]:
+    cache_path = None
+    cached = None
+    headers: Dict[str, str] = {}
+    if cache_dir is not None:
+        cache_path = cache_dir / user / f"{key}.json"
+        try:
+            cached = load_json(cache_path.read_bytes())
+        except (OSError, ValueError):
+            cached = None
+        if isinstance(cached, dict) and isinstance(cached.get("version"), int):
+            headers["If-Modified-Since-Version"] = str(cached["version"])
+    wait_for_backoff()
     response = session.get(
         f"https://api.zotero.org/users/{user}/items/{key}",
-        headers=zotero_headers(api_key),
+        headers=headers,
         params={"format": "json"},
         timeout=REQUEST_TIMEOUT,
     )
+    if response.status_code == 304 and cached is not None:
+        return cached
     response.raise_for_status()
-    return response.json()
+    if cache_path is not None:
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        write_file_atomic(cache_path, response.content)
+    return load_json(response.content)
+
+
+def imap_bounded(
+    func: Callable[..., Any],
+    calls: Iterator[tuple],
+    concurrency: int,
+) -> Iterator[Any]:
+    workers = max(1, concurrency)
+    executor = ThreadPoolExecutor(max_workers=workers)
+    try:
+        pending = set()
+        for call_args in calls:
+            pending.add(executor.submit(func, *call_args))
+            if len(pending) < workers * 2:
+                continue
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+
+def iter_item_pages(
+    session: requests.Session,
+    user: str,
+    start: int,
+    limit: int,
+    max_items: Optional[int],
+    concurrency: int,
+) -> Iterator[Tuple[list, Optional[int], Optional[int]]]:
+    end = None if max_items is None else start + max_items
+    page_limit = limit if end is None else min(limit, end - start)
+    if page_limit <= 0:
+        return
+    items, total, version = fetch_items_page(session, user, start, page_limit)
+    yield items, total, version
+    if not items:
+        return
+    start += limit
+
+    if total is None:
+        while end is None or start < end:
+            page_limit = limit if end is None else min(limit, end - start)
+            items, total, version = fetch_items_page(session, user, start, page_limit)
+            yield items, total, version
+            if not items:
+                return
+            start += limit
+        return
+
+    end = total if end is None else min(end, total)
+    calls = (
+        (session, user, offset, min(limit, end - offset))
+        for offset in range(start, end, limit)
+    )
+    yield from imap_bounded(fetch_items_page, calls, concurrency)
+
+
+def iter_key_pages(
+    session: requests.Session,
+    user: str,
+    keys: List[str],
+    concurrency: int,
+) -> Iterator[Tuple[list, Optional[int], Optional[int]]]:
+    calls = (
+        (session, user, keys[offset : offset + ITEM_KEY_BATCH])
+        for offset in range(0, len(keys), ITEM_KEY_BATCH)
+    )
+    for items in imap_bounded(fetch_items_by_keys, calls, concurrency):
+        yield items, len(keys), None
+
+
+def ensure_dir(path: Path) -> None:
+    try:
+        os.mkdir(path)
+    except FileExistsError:
+        pass
+
+
+def write_file_atomic(path: Path, data: bytes) -> None:
+    tmp_path = path.with_name(f"{path.name}.tmp")
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        try:
+            view = memoryview(data)
+            while view:
+                view = view[os.write(fd, view) :]
+        finally:
+            os.close(fd)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    os.replace(tmp_path, path)
+
+
+def file_has_bytes(path: Path, data: bytes) -> bool:
+    try:
+        return path.stat().st_size == len(data) and path.read_bytes() == data
+    except FileNotFoundError:
+        return False
 
 
 def save_item(
     item: Dict[str, Any],
     output_dir: Path,
-    snapshot_suffix: Optional[str],
+    snapshot_name: Optional[str],
     include_attachments: bool,
 ) -> bool:
     data = item.get("data", item)
@@ -111,21 +344,24 @@ def save_item(
     if not key:
         return False
     item_dir = output_dir / key
-    item_dir.mkdir(parents=True, exist_ok=True)
-    with open(item_dir / "original.json", "w", encoding="utf-8") as f:
-        json.dump(item, f, indent=2)
-    if snapshot_suffix:
-        snapshot_path = item_dir / f"original-{snapshot_suffix}.json"
-        with open(snapshot_path, "w", encoding="utf-8") as f:
-            json.dump(item, f, indent=2)
+    ensure_dir(item_dir)
+    original_path = item_dir / "original.json"
+    data_bytes = dump_json(item, indent=True)
+    changed = not file_has_bytes(original_path, data_bytes)
+    if changed:
+        write_file_atomic(original_path, data_bytes)
+    if snapshot_name:
+        snapshot_path = item_dir / snapshot_name
+        if changed or not snapshot_path.exists():
+            write_file_atomic(snapshot_path, data_bytes)
     return True
 
 
-def load_json_input(path: str) -> Dict[str, Any]:
+def read_json_input(path: str) -> bytes:
     if path == "-":
-        return json.load(sys.stdin)
-    with open(path, "r", encoding="utf-8") as f:
-        return json.load(f)
+        return sys.stdin.buffer.read()
+    with open(path, "rb") as f:
+        return f.read()
 
 
 def normalize_payload(payload: Dict[str, Any], data_only: bool) -> Dict[str, Any]:
@@ -136,66 +372,136 @@ def normalize_payload(payload: Dict[str, Any], data_only: bool) -> Dict[str, Any
     return payload
 
 
+def load_sync_version(
+    path: Path,
+    user: str,
+    include_attachments: bool,
+) -> Optional[int]:
+    try:
+        state = load_json(path.read_bytes())
+    except (OSError, ValueError):
+        return None
+    if not isinstance(state, dict):
+        return None
+    if state.get("user") != user:
+        return None
+    if include_attachments and not state.get("include_attachments"):
+        return None
+    version = state.get("version")
+    return version if isinstance(version, int) else None
+
+
+def save_sync_version(
+    path: Path,
+    user: str,
+    version: int,
+    include_attachments: bool,
+) -> None:
+    state = {
+        "user": user,
+        "version": version,
+        "include_attachments": include_attachments,
+    }
+    write_file_atomic(path, dump_json(state, indent=True))
+
+
 def cmd_download(args: argparse.Namespace) -> None:
     user, api_key = resolve_auth(args)
-    session = build_session()
+    session = build_session(api_key, pool_size=max(POOL_SIZE, args.concurrency))
 
     output_dir = Path(args.output_dir)
     output_dir.mkdir(parents=True, exist_ok=True)
 
-    start = args.start
+    state_path = output_dir / SYNC_STATE_FILE
+    full_sync = args.start == 0 and args.max_items is None
+    since_version = None
+    if full_sync and not args.full:
+        since_version = load_sync_version(state_path, user, args.include_attachments)
+
     processed = 0
     saved = 0
-    total = None
-    snapshot_suffix = None if args.no_snapshot else datetime.now().strftime("%m-%d")
-
-    while True:
-        if args.max_items is not None:
-            remaining = args.max_items - processed
-            if remaining <= 0:
-                break
-            limit = min(args.limit, remaining)
+    library_version = None
+    snapshot_name = None
+    if not args.no_snapshot:
+        snapshot_name = f"original-{datetime.now().strftime('%m-%d')}.json"
+
+    if since_version is not None:
+        item_type = None if args.include_attachments else "-attachment"
+        versions, library_version = fetch_versions(
+            session, user, since_version, item_type=item_type
+        )
+        if not versions:
+            print(f"Library unchanged since version {since_version}")
         else:
-            limit = args.limit
-
-        items, total = fetch_items_page(session, user, api_key, start, limit)
-        if not items:
-            break
-        processed += len(items)
-        for item in items:
-            if save_item(item, output_dir, snapshot_suffix, args.include_attachments):
-                saved += 1
-
-        total_display = total if total is not None else "?"
-        print(f"Fetched {processed}/{total_display} items, saved {saved}")
-
-        start += limit
-        if total is not None and start >= total:
-            break
+            print(f"{len(versions)} items changed since version {since_version}")
+        pages = iter_key_pages(session, user, sorted(versions), args.concurrency)
+    else:
+        pages = iter_item_pages(
+            session,
+            user,
+            args.start,
+            args.limit,
+            args.max_items,
+            args.concurrency,
+        )
+    with ThreadPoolExecutor(max_workers=WRITER_WORKERS) as writer_pool:
+        for items, total, version in pages:
+            if library_version is None:
+                library_version = version
+            if not items:
+                continue
+            processed += len(items)
+            futures = [
+                writer_pool.submit(
+                    save_item,
+                    item,
+                    output_dir,
+                    snapshot_name,
+                    args.include_attachments,
+                )
+                for item in items
+            ]
+            saved += sum(future.result() for future in futures)
+
+            total_display = total if total is not None else "?"
+            print(f"Fetched {processed}/{total_display} items, saved {saved}")
+
+    if full_sync and library_version is not None:
+        save_sync_version(
+            state_path, user, library_version, args.include_attachments
+        )
 
 
 def cmd_get(args: argparse.Namespace) -> None:
     user, api_key = resolve_auth(args)
-    session = build_session()
-
-    item = fetch_item(session, user, api_key, args.key)
+    session = build_session(api_key)
+
+    if args.keys is not None and args.cache_dir:
+        raise SystemExit("--cache-dir can only be used with --key")
+    if args.keys is not None:
+        keys = [key.strip() for key in args.keys.split(",") if key.strip()]
+        if not keys:
+            raise SystemExit("--keys needs at least one item key")
+        result = fetch_items_by_keys(session, user, keys)
+    else:
+        cache_dir = Path(args.cache_dir) if args.cache_dir else None
+        result = fetch_item(session, user, args.key, cache_dir=cache_dir)
     if args.output:
         output_path = Path(args.output)
         output_path.parent.mkdir(parents=True, exist_ok=True)
-        with open(output_path, "w", encoding="utf-8") as f:
-            json.dump(item, f, indent=2)
+        with open(output_path, "wb") as f:
+            f.write(dump_json(result, indent=True))
     else:
-        print(json.dumps(item, ensure_ascii=False, indent=2))
+        write_json_stdout(result)
 
 
 def cmd_search(args: argparse.Namespace) -> None:
     user, api_key = resolve_auth(args)
-    session = build_session()
+    session = build_session(api_key)
 
-    items, total = fetch_items_page(
+    items, total, _ = fetch_items_page(
         session,
         user,
-        api_key,
         args.start,
         args.limit,
         query=args.query,
@@ -207,10 +513,10 @@ def cmd_search(args: argparse.Namespace) -> None:
     if args.output:
         output_path = Path(args.output)
         output_path.parent.mkdir(parents=True, exist_ok=True)
-        with open(output_path, "w", encoding="utf-8") as f:
-            json.dump(items, f, ensure_ascii=False, indent=2)
+        with open(output_path, "wb") as f:
+            f.write(dump_json(items, indent=True))
     else:
-        print(json.dumps(items, ensure_ascii=False, indent=2))
+        write_json_stdout(items)
 
     if total is not None:
         print(f"Total-Results: {total}")
@@ -237,16 +543,19 @@ def normalize_create_payload(payload: Any, data_only: bool) -> list:
 
 def cmd_create(args: argparse.Namespace) -> None:
     user, api_key = resolve_auth(args)
-    session = build_session()
+    session = build_session(api_key)
 
-    payload = load_json_input(args.input)
-    payload = normalize_create_payload(payload, args.data_only)
+    raw = read_json_input(args.input)
+    if args.data_only and raw.lstrip()[:1] == b"[":
+        body = raw
+    else:
+        payload = normalize_create_payload(load_json(raw), args.data_only)
+        body = dump_json(payload)
 
     response = session.post(
         f"https://api.zotero.org/users/{user}/items",
-        headers=zotero_headers(api_key),
         params={"format": "json"},
-        data=json.dumps(payload),
+        data=body,
         timeout=REQUEST_TIMEOUT,
     )
     print(f"Status: {response.status_code}")
@@ -255,16 +564,18 @@ def cmd_create(args: argparse.Namespace) -> None:
 
 def cmd_update(args: argparse.Namespace) -> None:
     user, api_key = resolve_auth(args)
-    session = build_session()
+    session = build_session(api_key)
 
-    payload = load_json_input(args.input)
-    payload = normalize_payload(payload, args.data_only)
+    raw = read_json_input(args.input)
+    if args.data_only:
+        body = raw
+    else:
+        body = dump_json(normalize_payload(load_json(raw), args.data_only))
 
     response = session.put(
         f"https://api.zotero.org/users/{user}/items/{args.key}",
-        headers=zotero_headers(api_key),
         params={"format": "json"},
-        data=json.dumps(payload),
+        data=body,
         timeout=REQUEST_TIMEOUT,
     )
     print(f"Status: {response.status_code}")
@@ -284,11 +595,28 @@ def build_parser() -> argparse.ArgumentParser:
     p_download.add_argument("--include-attachments", action="store_true")
     p_download.add_argument("--start", type=int, default=0)
     p_download.add_argument("--no-snapshot", action="store_true")
+    p_download.add_argument(
+        "--concurrency",
+        type=int,
+        default=DEFAULT_CONCURRENCY,
+        help="Number of pages fetched in parallel",
+    )
+    p_download.add_argument(
+        "--full",
+        action="store_true",
+        help="Ignore the saved library version and download every item",
+    )
     p_download.set_defaults(func=cmd_download)
 
-    p_get = sub.add_parser("get", help="Fetch a single item")
-    p_get.add_argument("--key", required=True)
+    p_get = sub.add_parser("get", help="Fetch a single item or a list of items")
+    p_get_keys = p_get.add_mutually_exclusive_group(required=True)
+    p_get_keys.add_argument("--key")
+    p_get_keys.add_argument("--keys", help="Comma-separated item keys")
     p_get.add_argument("--output")
+    p_get.add_argument(
+        "--cache-dir",
+        help="Cache the item here and revalidate it (only with --key)",
+    )
     p_get.set_defaults(func=cmd_get)
 
     p_search = sub.add_parser("search", help="Search items")